@@ -2,58 +2,220 @@
 
 from __future__ import annotations
 
+import asyncio
+import atexit
+import inspect
 import json
 import os
-from typing import Any, Dict, List, Optional
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
 
+import httpx
 import ollama
 
+_INDENT_RE = re.compile(r"[ \t]*")
+
+
+def _accepts_keyword(function: Callable[..., Any], name: str) -> bool:
+    """Return whether `function` can be called with keyword argument `name`."""
+    try:
+        parameters = inspect.signature(function).parameters
+    except (TypeError, ValueError):
+        return True
+    if name in parameters:
+        return True
+    return any(parameter.kind is inspect.Parameter.VAR_KEYWORD for parameter in parameters.values())
+
+
+class _CursorContext(NamedTuple):
+    """Cursor-split views of a document shared by every prompt style."""
+
+    prefix: str
+    suffix: str
+    indent: str
+    centered_prefix: str
+
+
+_FIM_PREFIX = "<|fim_prefix|>"
+_FIM_SUFFIX = "<|fim_suffix|>"
+_FIM_MIDDLE = "<|fim_middle|>"
+
+# Chunk normalizers keyed by chunk type; a stream always yields the same SDK type.
+_NORMALIZER_CACHE: Dict[type, Callable[[Any], Dict[str, Any]]] = {}
+
+
+def _resolve_normalizer(chunk_type: type) -> Callable[[Any], Dict[str, Any]]:
+    """Pick the dict conversion for a chunk type: dicts as-is, then pydantic v2, then v1, else text."""
+    if issubclass(chunk_type, dict):
+        return lambda chunk: chunk
+    if hasattr(chunk_type, "model_dump"):
+        return chunk_type.model_dump
+    if hasattr(chunk_type, "dict"):
+        return chunk_type.dict
+    return lambda chunk: {"response": str(chunk)}
+
 
 class CompletionEngine:
     """Builds suffix-aware completion payloads and streams completions from Ollama."""
 
+    # Fixed attribute layout: the payload builders and per-chunk stream path read
+    # these on every call, and slot access skips the instance `__dict__` probe.
+    __slots__ = (
+        "model",
+        "client",
+        "options",
+        "fim_enabled",
+        "fim_mode",
+        "context_lines_before",
+        "context_lines_after",
+        "max_prefix_chars",
+        "max_suffix_chars",
+        "debug",
+        "debug_log_file",
+        "keep_alive",
+        "stream_batch_ms",
+        "_suffix_supported",
+        "_build_payload",
+        "_payload_base",
+        "_indent_literals",
+        "_json_encode",
+        "_debug_buffer",
+        "_debug_lock",
+        "_debug_timer",
+        "_debug_fh",
+    )
+
+    # Engine knobs popped from `options` before the rest is sent to Ollama: (attribute, default, cast).
+    _KNOBS = (
+        ("fim_enabled", True, bool),
+        ("fim_mode", "auto", str),
+        ("context_lines_before", 80, int),
+        ("context_lines_after", 40, int),
+        ("max_prefix_chars", 8000, int),
+        ("max_suffix_chars", 3000, int),
+        ("debug", False, bool),
+        ("stream_batch_ms", 0, float),
+        # How long Ollama keeps the model loaded (a duration string or seconds), passed
+        # through uncast; a falsy value leaves the server default (5m) in place.
+        ("keep_alive", "30m", lambda value: value),
+    )
+
+    # Fixed segments of the centered (non-FIM) prompt, joined around the dynamic fields.
+    _CENTERED_HEAD = (
+        "[AUTOCOMPLETE_TASK]\n"
+        "Return ONLY the exact text to insert at <CURSOR>.\n"
+        "Do not restate existing text. Do not explain. Do not use markdown fences.\n"
+        "filetype="
+    )
+    _CENTERED_INDENT = "\nindentation="
+    _CENTERED_BEFORE = "\n[PREFIX_BEFORE_CURSOR]\n"
+    _CENTERED_LINE_PREFIX = "\n[CURRENT_LINE_PREFIX]\n"
+    _CENTERED_LINE_SUFFIX = "\n[CURRENT_LINE_SUFFIX]\n"
+    # The trailing blank line is part of the prompt sent to Ollama.
+    _CENTERED_TAIL = "\n[INSERT_AT_CURSOR]\n\n"
+    _INDENT_LITERAL_CACHE_SIZE = 8
+
+    # Debug records are buffered and written in batches to keep file I/O off the token loop.
+    _DEBUG_FLUSH_THRESHOLD = 32
+    _DEBUG_FLUSH_INTERVAL = 0.5
+    _DEBUG_FILE_BUFFER_SIZE = 64 * 1024
+
+    _HTTP_LIMITS = httpx.Limits(max_keepalive_connections=4, keepalive_expiry=60)
+
     def __init__(self, model: str, client_url: str = "http://localhost:11434", options: Optional[Dict[str, Any]] = None):
         """Initialize engine with model, Ollama endpoint, and generation controls."""
         self.model = model
-        self.client = ollama.Client(client_url)
-        self.options = options or {}
-
-        self.fim_enabled = self.options.pop("fim_enabled", True)
-        self.fim_mode = self.options.pop("fim_mode", "auto")
-        self.context_lines_before = int(self.options.pop("context_lines_before", 80))
-        self.context_lines_after = int(self.options.pop("context_lines_after", 40))
-        self.max_prefix_chars = int(self.options.pop("max_prefix_chars", 8000))
-        self.max_suffix_chars = int(self.options.pop("max_suffix_chars", 3000))
+        # Keep pooled connections warm across debounced keystrokes so completions
+        # don't pay a fresh TCP handshake after every short typing pause.
+        self.client = ollama.Client(client_url, limits=self._HTTP_LIMITS)
+        # Older Ollama python clients have no `suffix` argument; detect that once and
+        # use the manual FIM prompt instead of failing and retrying every request.
+        self._suffix_supported = _accepts_keyword(self.client.generate, "suffix")
+        # Copy so popping engine knobs never mutates the caller's dict; the remaining
+        # model options are sent as-is on every request.
+        self.options = dict(options or {})
+
+        for name, default, cast in self._KNOBS:
+            setattr(self, name, cast(self.options.pop(name, default)))
 
         # Debugging can be toggled with init option or env vars.
-        self.debug = bool(self.options.pop("debug", False)) or os.getenv("OLLAMA_COPILOT_DEBUG", "") == "1"
+        self.debug = self.debug or os.getenv("OLLAMA_COPILOT_DEBUG", "") == "1"
         self.debug_log_file = self.options.pop("debug_log_file", None) or os.getenv(
             "OLLAMA_COPILOT_DEBUG_LOG",
             "/tmp/ollama-copilot-debug.log",
         )
 
+        # FIM settings are fixed for the engine's lifetime, so pick the payload
+        # builder once rather than re-branching on every keystroke.
+        if not self.fim_enabled:
+            self._build_payload = self._build_centered_payload
+        elif self._suffix_supported and self.fim_mode in ("auto", "template"):
+            self._build_payload = self._build_template_fim_payload
+        else:
+            self._build_payload = self._build_manual_fim_payload
+
+        self._payload_base: Dict[str, Any] = {
+            "model": self.model,
+            "stream": True,
+            "options": self.options,
+        }
+        # Like `suffix`, older clients have no `keep_alive` argument and would reject it.
+        if self.keep_alive and _accepts_keyword(self.client.generate, "keep_alive"):
+            self._payload_base["keep_alive"] = self.keep_alive
+
+        self._indent_literals: Dict[str, str] = {}
+
+        self._json_encode = json.JSONEncoder(default=str, separators=(",", ":")).encode
+        self._debug_buffer: deque[str] = deque()
+        self._debug_lock = threading.Lock()
+        self._debug_timer: Optional[threading.Timer] = None
+        self._debug_fh = None
+        if self.debug:
+            atexit.register(self._debug_flush)
+
     def complete(self, lines: List[str], line: int, character: int, filetype: str = ""):
         """Stream completion tokens for the insertion point using FIM when enabled."""
-        payload = self.build_request_payload(lines=lines, line=line, character=character, filetype=filetype)
-        self._debug_log("payload", payload)
+        return self.dispatch(self.prepare(lines=lines, line=line, character=character, filetype=filetype))
 
+    async def complete_async(self, lines: List[str], line: int, character: int, filetype: str = ""):
+        """Async variant of `complete` that keeps payload building and network I/O off the event loop.
+
+        Cancelling the consuming task aborts the in-flight Ollama stream.
+        """
+        payload = await asyncio.to_thread(self.prepare, lines, line, character, filetype)
+        stream = await asyncio.to_thread(self.client.generate, **payload)
+        chunks = self._debug_stream(stream)
+
+        loop = asyncio.get_running_loop()
+        pending = None
         try:
-            stream = self.client.generate(**payload)
-            return self._debug_stream(stream)
-        except TypeError as exc:
-            # Fallback for older Ollama python client versions without `suffix` support.
-            if "suffix" not in str(exc):
-                raise
-            fallback_payload = self.build_request_payload(
-                lines=lines,
-                line=line,
-                character=character,
-                filetype=filetype,
-                force_manual_fim=True,
-            )
-            self._debug_log("payload_fallback", fallback_payload)
-            stream = self.client.generate(**fallback_payload)
-            return self._debug_stream(stream)
+            while True:
+                # Shielded so a cancel never closes the stream while a worker is inside `next`.
+                pending = loop.run_in_executor(None, next, chunks, None)
+                chunk = await asyncio.shield(pending)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                if pending is not None and not pending.done():
+                    pending.add_done_callback(lambda _: close())
+                else:
+                    close()
+
+    def prepare(self, lines: List[str], line: int, character: int, filetype: str = "") -> Dict[str, Any]:
+        """Build and log the request payload; CPU-only, so it can run off the event loop."""
+        payload = self._build_payload(lines, line, character, filetype)
+        self._debug_log("payload", payload)
+        return payload
+
+    def dispatch(self, payload: Dict[str, Any]):
+        """Send a prepared payload to Ollama and return the normalized chunk stream."""
+        return self._debug_stream(self.client.generate(**payload))
 
     def build_request_payload(
         self,
@@ -61,108 +223,182 @@ class CompletionEngine:
         line: int,
         character: int,
         filetype: str = "",
-        force_manual_fim: bool = False,
     ) -> Dict[str, Any]:
         """Construct Ollama `generate` payload with prompt/suffix and constrained options."""
-        prefix, suffix, local_indent = self._split_prefix_suffix(lines=lines, line=line, character=character)
-        centered_prefix = self._centered_prefix(lines=lines, line=line, character=character, filetype=filetype, indent=local_indent)
-
-        payload: Dict[str, Any] = {
-            "model": self.model,
-            "stream": True,
-            "options": self.options,
-        }
-
-        use_template_fim = self.fim_enabled and not force_manual_fim and self.fim_mode in ("auto", "template")
-
-        if use_template_fim:
-            payload["prompt"] = prefix[-self.max_prefix_chars :]
-            payload["suffix"] = suffix[: self.max_suffix_chars]
-            return payload
+        return self._build_payload(lines, line, character, filetype)
+
+    def _build_template_fim_payload(self, lines: List[str], line: int, character: int, filetype: str) -> Dict[str, Any]:
+        """Send prefix and suffix separately for the model's Ollama template to wrap."""
+        context = self._build_contexts(lines, line, character, filetype, centered=False)
+        payload = dict(self._payload_base)
+        payload["prompt"] = context.prefix
+        payload["suffix"] = context.suffix
+        return payload
 
-        if self.fim_enabled:
-            payload["prompt"] = self._manual_fim_prompt(prefix[-self.max_prefix_chars :], suffix)
-            return payload
+    def _build_manual_fim_payload(self, lines: List[str], line: int, character: int, filetype: str) -> Dict[str, Any]:
+        """Wrap prefix and suffix in FIM sentinel tokens inside the prompt itself."""
+        context = self._build_contexts(lines, line, character, filetype, centered=False)
+        payload = dict(self._payload_base)
+        payload["prompt"] = self._manual_fim_prompt(context.prefix, context.suffix)
+        return payload
 
-        payload["prompt"] = centered_prefix + "\n"
+    def _build_centered_payload(self, lines: List[str], line: int, character: int, filetype: str) -> Dict[str, Any]:
+        """Send the cursor-local instruction prompt when FIM is disabled."""
+        context = self._build_contexts(lines, line, character, filetype)
+        payload = dict(self._payload_base)
+        payload["prompt"] = context.centered_prefix
         return payload
 
-    def _split_prefix_suffix(self, lines: List[str], line: int, character: int) -> tuple[str, str, str]:
-        """Return full-document prefix and suffix split at cursor, plus local indent."""
+    def _build_contexts(
+        self,
+        lines: List[str],
+        line: int,
+        character: int,
+        filetype: str,
+        centered: bool = True,
+    ) -> _CursorContext:
+        """Return budget-bounded prefix/suffix, local indent, and (optionally) centered prompt in one pass."""
         bounded_line = max(0, min(line, len(lines) - 1)) if lines else 0
         current_line = lines[bounded_line] if lines else ""
         bounded_character = max(0, min(character, len(current_line)))
 
         left = current_line[:bounded_character]
         right = current_line[bounded_character:]
-        indent = left[: len(left) - len(left.lstrip(" \t"))]
-
-        prefix = "\n".join(lines[:bounded_line])
-        prefix = f"{prefix}\n{left}" if prefix else left
-        suffix = right
-        if bounded_line + 1 < len(lines):
-            suffix = f"{suffix}\n" + "\n".join(lines[bounded_line + 1 :])
-
-        return prefix, suffix, indent
-
-    def _centered_prefix(self, lines: List[str], line: int, character: int, filetype: str, indent: str) -> str:
-        """Build a cursor-local instruction block with bounded surrounding context."""
-        if not lines:
-            lines = [""]
-
-        bounded_line = max(0, min(line, len(lines) - 1))
-        current_line = lines[bounded_line]
-        bounded_character = max(0, min(character, len(current_line)))
-
+        indent = left[: _INDENT_RE.match(left).end()]
+
+        # Walk outward from the cursor only until each character budget is met,
+        # so large buffers never get joined in full on every keystroke. The walks
+        # only do length arithmetic; the retained lines are taken with one slice.
+        max_prefix_chars = self.max_prefix_chars
+        prefix_budget = max_prefix_chars - len(left)
+        first = bounded_line
+        before_size = 0
+        while first > 0 and before_size < prefix_budget:
+            first -= 1
+            before_size += len(lines[first]) + 1
+
+        prefix_parts = lines[first:bounded_line]
+        prefix_parts.append(left)
+        prefix = "\n".join(prefix_parts)
+        if len(prefix) > max_prefix_chars:
+            prefix = prefix[len(prefix) - max_prefix_chars :]
+
+        max_suffix_chars = self.max_suffix_chars
+        line_count = len(lines)
+        last = bounded_line + 1
+        suffix_size = len(right)
+        while last < line_count and suffix_size < max_suffix_chars:
+            suffix_size += len(lines[last]) + 1
+            last += 1
+
+        suffix_parts = [right]
+        suffix_parts.extend(lines[bounded_line + 1 : last])
+        suffix = "\n".join(suffix_parts)
+        if len(suffix) > max_suffix_chars:
+            suffix = suffix[:max_suffix_chars]
+
+        if not centered:
+            return _CursorContext(prefix, suffix, indent, "")
+
+        # The centered prompt keeps the nearest lines within `context_lines_before`
+        # up to the same budget, so it resumes the backward walk where the prefix stopped.
         start = max(0, bounded_line - self.context_lines_before)
-        before_lines = lines[start:bounded_line]
-        line_prefix = current_line[:bounded_character]
-        line_suffix = current_line[bounded_character:]
-
-        before_text = "\n".join(before_lines)
-        if len(before_text) > self.max_prefix_chars:
-            before_text = before_text[-self.max_prefix_chars :]
-
-        return (
-            "[AUTOCOMPLETE_TASK]\n"
-            "Return ONLY the exact text to insert at <CURSOR>.\n"
-            "Do not restate existing text. Do not explain. Do not use markdown fences.\n"
-            f"filetype={filetype or 'plain'}\n"
-            f"indentation={json.dumps(indent)}\n"
-            "[PREFIX_BEFORE_CURSOR]\n"
-            f"{before_text}\n"
-            "[CURRENT_LINE_PREFIX]\n"
-            f"{line_prefix}\n"
-            "[CURRENT_LINE_SUFFIX]\n"
-            f"{line_suffix}\n"
-            "[INSERT_AT_CURSOR]\n"
+        centered_first = max(first, start)
+        if first >= start:
+            while centered_first > start and before_size <= max_prefix_chars:
+                centered_first -= 1
+                before_size += len(lines[centered_first]) + 1
+
+        before_text = "\n".join(lines[centered_first:bounded_line])
+        if len(before_text) > max_prefix_chars:
+            before_text = before_text[len(before_text) - max_prefix_chars :]
+        centered_prefix = self._centered_prefix(filetype, indent, before_text, left, right)
+
+        return _CursorContext(prefix, suffix, indent, centered_prefix)
+
+    def _centered_prefix(self, filetype: str, indent: str, before_text: str, line_prefix: str, line_suffix: str) -> str:
+        """Build the cursor-local instruction prompt with bounded surrounding context."""
+        return "".join(
+            (
+                self._CENTERED_HEAD,
+                filetype or "plain",
+                self._CENTERED_INDENT,
+                self._indent_literal(indent),
+                self._CENTERED_BEFORE,
+                before_text,
+                self._CENTERED_LINE_PREFIX,
+                line_prefix,
+                self._CENTERED_LINE_SUFFIX,
+                line_suffix,
+                self._CENTERED_TAIL,
+            )
         )
 
+    def _indent_literal(self, indent: str) -> str:
+        """Return the JSON-quoted indent, memoized since buffers reuse a handful of indents."""
+        literal = self._indent_literals.get(indent)
+        if literal is None:
+            if len(self._indent_literals) >= self._INDENT_LITERAL_CACHE_SIZE:
+                self._indent_literals.clear()
+            literal = self._indent_literals[indent] = json.dumps(indent)
+        return literal
+
     def _manual_fim_prompt(self, prefix: str, suffix: str) -> str:
         """Construct model-native manual FIM wrapper for models expecting special tokens."""
-        bounded_suffix = suffix[: self.max_suffix_chars]
-        return f"<|fim_prefix|>{prefix}<|fim_suffix|>{bounded_suffix}<|fim_middle|>"
+        return "".join((_FIM_PREFIX, prefix, _FIM_SUFFIX, suffix[: self.max_suffix_chars], _FIM_MIDDLE))
 
     def _debug_stream(self, stream):
-        """Wrap stream iterator and log raw chunks when debug mode is enabled."""
+        """Wrap stream iterator, log raw chunks when debug mode is enabled, and batch if configured."""
+        normalize = self._normalize_chunk
+        if not self.debug:
+            # No per-chunk logging work or generator frame when debugging is off.
+            chunks = map(normalize, stream)
+        else:
+            log = self._debug_log
+
+            def iterator():
+                for chunk in stream:
+                    normalized_chunk = normalize(chunk)
+                    log("raw_chunk", normalized_chunk)
+                    yield normalized_chunk
+
+            chunks = iterator()
+
+        if self.stream_batch_ms > 0:
+            return self._batch_stream(chunks)
+        return chunks
+
+    def _batch_stream(self, chunks):
+        """Coalesce chunks arriving within `stream_batch_ms` into one chunk with joined response text."""
+        interval = self.stream_batch_ms / 1000
+
         def iterator():
-            for chunk in stream:
-                normalized_chunk = self._normalize_chunk(chunk)
-                if self.debug:
-                    self._debug_log("raw_chunk", normalized_chunk)
-                yield normalized_chunk
+            pending: List[str] = []
+            flush_at = time.monotonic() + interval
+            for chunk in chunks:
+                pending.append(chunk.get("response") or "")
+                # The final chunk carries timing stats, so it always flushes immediately.
+                if chunk.get("done") or time.monotonic() >= flush_at:
+                    merged = dict(chunk)
+                    merged["response"] = "".join(pending)
+                    pending.clear()
+                    flush_at = time.monotonic() + interval
+                    yield merged
+
+            if pending:
+                merged = dict(chunk)
+                merged["response"] = "".join(pending)
+                yield merged
 
         return iterator()
 
     def _normalize_chunk(self, chunk: Any) -> Dict[str, Any]:
         """Convert Ollama SDK response chunks into plain dicts for stable indexing."""
-        if isinstance(chunk, dict):
-            return chunk
-        if hasattr(chunk, "model_dump"):
-            return chunk.model_dump()
-        if hasattr(chunk, "dict"):
-            return chunk.dict()
-        return {"response": str(chunk)}
+        chunk_type = type(chunk)
+        normalizer = _NORMALIZER_CACHE.get(chunk_type)
+        if normalizer is None:
+            normalizer = _NORMALIZER_CACHE[chunk_type] = _resolve_normalizer(chunk_type)
+        return normalizer(chunk)
 
     def _debug_log(self, event: str, payload: Any) -> None:
         """Append debug records to a local log file without disturbing stdio LSP traffic."""
@@ -176,9 +412,39 @@ class CompletionEngine:
             serializable_payload = payload.dict()
 
         try:
-            with open(self.debug_log_file, "a", encoding="utf-8") as handle:
-                handle.write(json.dumps({"event": event, "payload": serializable_payload}, default=str))
-                handle.write("\n")
+            self._debug_buffer.append(self._json_encode({"event": event, "payload": serializable_payload}) + "\n")
         except Exception:
             # Debug logging must never break completions.
             return
+
+        if len(self._debug_buffer) >= self._DEBUG_FLUSH_THRESHOLD:
+            self._debug_flush()
+            return
+
+        with self._debug_lock:
+            if self._debug_timer is None:
+                self._debug_timer = threading.Timer(self._DEBUG_FLUSH_INTERVAL, self._debug_flush)
+                self._debug_timer.daemon = True
+                self._debug_timer.start()
+
+    def _debug_flush(self) -> None:
+        """Write buffered debug records through a lazily opened, block-buffered handle."""
+        with self._debug_lock:
+            if self._debug_timer is not None:
+                self._debug_timer.cancel()
+                self._debug_timer = None
+
+            records = []
+            while self._debug_buffer:
+                records.append(self._debug_buffer.popleft())
+            if not records:
+                return
+
+            try:
+                if self._debug_fh is None:
+                    self._debug_fh = open(self.debug_log_file, "a", encoding="utf-8", buffering=self._DEBUG_FILE_BUFFER_SIZE)
+                self._debug_fh.writelines(records)
+                self._debug_fh.flush()
+            except Exception:
+                # Debug logging must never break completions.
+                return
@@ -15,10 +15,6 @@ import asyncio
 def send_log(message, line, col, file="f/na"): 
     """No-op logger retained for backwards compatibility hooks."""
     return
-async def async_generator_wrapper(generator):
-    for item in generator:
-        yield item
-
 class OllamaServer:
     """Neovim-facing LSP transport for completion requests and suggestion state."""
 
@@ -30,6 +26,9 @@ class OllamaServer:
         self.debounce_time = 0.5  # Debounce time in seconds
         self.last_completion_request = None
         self.debounce_task = None
+        # Bumped whenever the suggestion is reset so in-flight completions know they are stale.
+        self.completion_generation = 0
+        self.streaming_suggestion = None
         self.register_features()
     
     def register_features(self):
@@ -99,52 +98,66 @@ class OllamaServer:
 
         document = self.server.workspace.get_text_document(params.text_document.uri)
         lines = document.lines
-        suggestion_stream = async_generator_wrapper(
-            self.engine.complete(
-                lines,
-                params.position.line,
-                params.position.character,
-                filetype=getattr(document, 'language_id', ''),
-            )
+        # Runs off the event loop; a newer debounced request cancels this one mid-stream.
+        suggestion_stream = self.engine.complete_async(
+            lines,
+            params.position.line,
+            params.position.character,
+            filetype=getattr(document, 'language_id', ''),
         )
 
-        self.curr_suggestion = {'line' : params.position.line + 1, 'character' : params.position.character, 'suggestion': ''}
+        # Built locally and only published if no edit superseded this completion while streaming.
+        # While in flight it is exposed as `streaming_suggestion`, so on_change can let the user
+        # type through text that is still arriving instead of treating it as a mismatch.
+        generation = self.completion_generation
+        suggestion = {'line' : params.position.line + 1, 'character' : params.position.character, 'suggestion': ''}
+        self.streaming_suggestion = suggestion
         timing_str = ''
 
-        async for chunk in suggestion_stream:
-            if self.cancel_suggestion:
-                self.cancel_suggestion = False
-                return []
-
-            self.curr_suggestion['suggestion'] += chunk.get('response') or ''
-            if chunk.get('context'):
-                total_duration = (chunk.get('total_duration') or 0) / 10**9
-                load_duration = (chunk.get('load_duration') or 0) / 10**9
-                prompt_eval_duration = (chunk.get('prompt_eval_duration') or 0) / 10**9
-                eval_count = chunk.get('eval_count') or 0
-                eval_duration = (chunk.get('eval_duration') or 0) / 10**9
-                timing_str = f"""
-                    Total duration: {total_duration},
-                    Load duration: {load_duration},
-                    Prompt eval duration: {prompt_eval_duration},
-                    Eval count: {eval_count},
-                    Eval duration: {eval_duration}"""
-            if self.stream_suggestion:
-                self.send_suggestion(self.curr_suggestion['suggestion'],
-                                     self.curr_suggestion['line'],
-                                     self.curr_suggestion['character'],
-                                     suggestion_type='stream')
-            
-        cleaned = self.strip_suggestion(self.curr_suggestion['suggestion'])
+        try:
+            async for chunk in suggestion_stream:
+                if self.cancel_suggestion:
+                    self.cancel_suggestion = False
+                    return []
+                if generation != self.completion_generation:
+                    return []
+
+                suggestion['suggestion'] += chunk.get('response') or ''
+                if chunk.get('context'):
+                    total_duration = (chunk.get('total_duration') or 0) / 10**9
+                    load_duration = (chunk.get('load_duration') or 0) / 10**9
+                    prompt_eval_duration = (chunk.get('prompt_eval_duration') or 0) / 10**9
+                    eval_count = chunk.get('eval_count') or 0
+                    eval_duration = (chunk.get('eval_duration') or 0) / 10**9
+                    timing_str = f"""
+                        Total duration: {total_duration},
+                        Load duration: {load_duration},
+                        Prompt eval duration: {prompt_eval_duration},
+                        Eval count: {eval_count},
+                        Eval duration: {eval_duration}"""
+                if self.stream_suggestion:
+                    self.send_suggestion(suggestion['suggestion'],
+                                         suggestion['line'],
+                                         suggestion['character'],
+                                         suggestion_type='stream')
+        finally:
+            if self.streaming_suggestion is suggestion:
+                self.streaming_suggestion = None
+
+        if generation != self.completion_generation:
+            return []
+
+        self.curr_suggestion = suggestion
+        cleaned = self.strip_suggestion(suggestion['suggestion'])
         if cleaned:
             self.send_suggestion(
                 cleaned,
-                self.curr_suggestion['line'],
-                self.curr_suggestion['character'],
+                suggestion['line'],
+                suggestion['character'],
                 suggestion_type='completion',
             )
         
-        send_log(f"{timing_str}: {self.curr_suggestion['suggestion']}",
+        send_log(f"{timing_str}: {suggestion['suggestion']}",
                    params.position.line,
                    params.position.character,
                    params.text_document.uri)
@@ -172,16 +185,23 @@ class OllamaServer:
         if contains_non_whitespace:
             return
 
-        if change.text == self.curr_suggestion['suggestion'][0:len(change.text)] and len(change.text) > 0: 
-            self.curr_suggestion['suggestion'] = self.curr_suggestion['suggestion'][len(change.text):]
-            self.curr_suggestion['character'] += len(change.text)
-            self.send_suggestion(self.curr_suggestion['suggestion'],
-                                 self.curr_suggestion['line'],
-                                 self.curr_suggestion['character'],
-                                 suggestion_type='fill_suggestion')
+        # Typing through a suggestion still streaming consumes it in place; the stream keeps
+        # appending to the same dict, so later chunks land after the typed text.
+        streaming = self.streaming_suggestion is not None
+        active = self.streaming_suggestion if streaming else self.curr_suggestion
+        if change.text == active['suggestion'][0:len(change.text)] and len(change.text) > 0: 
+            active['suggestion'] = active['suggestion'][len(change.text):]
+            active['character'] += len(change.text)
+            # Nothing is on screen yet for a non-streamed completion still in flight.
+            if not streaming or self.stream_suggestion:
+                self.send_suggestion(active['suggestion'],
+                                     active['line'],
+                                     active['character'],
+                                     suggestion_type='fill_suggestion')
             return
         else:
             self.curr_suggestion = {'line' : 1, 'character' : 0, 'suggestion': ''}
+            self.cancel_completion()
             self.clear_suggestion()
             # Trigger a new completion
             position = types.Position(line=change.range.end.line, character=change.range.end.character + 1)
@@ -197,6 +217,15 @@ class OllamaServer:
             self.debounce_completion(completion_params)
         return
             
+    def cancel_completion(self):
+        """Drop any pending or streaming completion so it cannot publish a stale suggestion."""
+        self.completion_generation += 1
+        self.streaming_suggestion = None
+        self.last_completion_request = None
+        if self.debounce_task:
+            self.debounce_task.cancel()
+            self.debounce_task = None
+
     def clear_suggestion(self):
         self.server.send_notification('$/clearSuggestion',{'message' : "clear current"})
 